@@ -0,0 +1,108 @@
+"""
+Minimal DER codec used to build KRB_AS_REQ and to walk KRB_ERROR/KRB_AS_REP
+messages without going through asn1crypto.
+
+Only single-byte identifiers are supported, which is enough for Kerberos:
+every universal, context-specific and application tag used by RFC 4120 has
+a number lower than 31.
+"""
+
+from typing import Iterator, Tuple
+
+
+INTEGER = 0x02
+BIT_STRING = 0x03
+OCTET_STRING = 0x04
+GENERAL_STRING = 0x1b
+GENERALIZED_TIME = 0x18
+SEQUENCE = 0x30
+
+
+def context(number: int) -> int:
+    """
+    Identifier of a constructed context-specific tag [<number>]
+    (i.e. an explicit tag)
+    """
+    return 0xa0 | number
+
+
+def application(number: int) -> int:
+    """
+    Identifier of a constructed application tag [APPLICATION <number>]
+    """
+    return 0x60 | number
+
+
+def read_tlv(buf: bytes, off: int) -> Tuple[int, int, int, int]:
+    """
+    Read the TLV starting at <off> in <buf>.
+
+    Returns (tag, length, value_off, next_off) where <value_off> is the
+    offset of the first byte of the value and <next_off> the offset of the
+    byte following the TLV.
+    """
+    if off + 2 > len(buf):
+        raise ValueError(f"Truncated DER header at offset {off}")
+    tag = buf[off]
+    length = buf[off + 1]
+    value_off = off + 2
+    if length & 0x80:
+        n = length & 0x7f
+        if n == 0 or value_off + n > len(buf):
+            raise ValueError(f"Invalid DER length at offset {off}")
+        length = int.from_bytes(buf[value_off:value_off + n], 'big')
+        value_off += n
+    next_off = value_off + length
+    if next_off > len(buf):
+        raise ValueError(f"Truncated DER value at offset {off}")
+    return (tag, length, value_off, next_off)
+
+
+def iter_tlvs(buf: bytes, off: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """
+    Iterate over the TLVs stored between <off> and <end> in <buf> (typically
+    the value of a SEQUENCE), yielding (tag, value_off, next_off) for each
+    of them.
+    """
+    while off < end:
+        tag, _, value_off, off = read_tlv(buf, off)
+        yield (tag, value_off, off)
+
+
+def emit_tlv(tag: int, payload: bytes) -> bytes:
+    """
+    Encode <payload> as a TLV with definite length
+    (short form under 128 bytes, long form otherwise)
+    """
+    length = len(payload)
+    if length < 0x80:
+        return bytes((tag, length)) + payload
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((tag, 0x80 | len(length_bytes))) + length_bytes + payload
+
+
+def emit_integer(value: int) -> bytes:
+    """
+    Encode a non-negative INTEGER
+    """
+    return emit_tlv(INTEGER, value.to_bytes(value.bit_length() // 8 + 1, 'big'))
+
+
+def read_integer(buf: bytes, off: int) -> int:
+    """
+    Decode the INTEGER whose TLV starts at <off> in <buf>
+    """
+    tag, _, value_off, next_off = read_tlv(buf, off)
+    if tag != INTEGER:
+        raise ValueError(f"Expected INTEGER at offset {off}, got tag 0x{tag:02x}")
+    return int.from_bytes(buf[value_off:next_off], 'big', signed=True)
+
+
+def read_string(buf: bytes, off: int) -> str:
+    """
+    Decode the GeneralString whose TLV starts at <off> in <buf>
+    """
+    tag, _, value_off, next_off = read_tlv(buf, off)
+    if tag != GENERAL_STRING:
+        raise ValueError(f"Expected GeneralString at offset {off}, got tag 0x{tag:02x}")
+    return buf[value_off:next_off].decode('latin1')
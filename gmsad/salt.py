@@ -19,13 +19,20 @@ Useful documentation:
 - [MS-KILE]: Microsoft "Kerberos Network Authentication Service V5 Extensions"
 """
 
-import struct
-import random
+import atexit
+import configparser
+import functools
+import logging
+import os
+import secrets
 import socket
-from typing import Any as AnyType
+from typing import Any, Container, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from asn1crypto.core import Sequence, SequenceOf, Integer, BitString, OctetString, GeneralString, \
-    GeneralizedTime, Any
+    GeneralizedTime
+
+from gmsad._der import read_tlv, iter_tlvs, read_integer, read_string, emit_tlv, emit_integer, \
+    context, application, INTEGER, SEQUENCE, BIT_STRING, GENERAL_STRING, GENERALIZED_TIME
 
 
 APPLICATION_TAG = 1
@@ -39,6 +46,7 @@ NT_PRINCIPAL = 1
 NT_SRV_INST = 2
 
 KDC_ERR_PREAUTH_REQUIRED = 25
+KRB_ERR_RESPONSE_TOO_BIG = 52
 
 PA_ETYPE_INFO2 = 19
 
@@ -47,23 +55,86 @@ AES256_CTS_HMAC_SHA1h96_ENC_TYPE = 18
 
 TIME_T_ZERO = "19700101000000Z"
 
-# UINT32_MAX_VAL = 0xFFFFFFFF
-INT32_MAX_VAL = 0x7FFFFFFF
+# The nonce is drawn from [0x40000000, 0x7FFFFFFF] (see _build_as_req_into)
+NONCE_MIN_VAL = 0x40000000
+NONCE_RANDOM_BITS = 30
+NONCE_LENGTH = 4
 
 KERBEROS_PORT = 88
 
+UDP_MAX_DATAGRAM_SIZE = 65535
+
+# In seconds. A DC usually answers in less than 50ms.
+UDP_TIMEOUT = 2
+TCP_TIMEOUT = 10
+
+# Connected sockets are reused across requests to the same DC, unless this
+# environment variable is set to a true value (1, yes, true, on)
+DISABLE_SOCKET_POOL_ENV = "GMSAD_DISABLE_SOCKET_POOL"
+
+# Python sockets are already non-inheritable, this only saves an fcntl()
+SOCK_CLOEXEC = getattr(socket, 'SOCK_CLOEXEC', 0)
+
+# Kerberos exchanges are latency sensitive
+IPTOS_LOWDELAY = 0x10
+
+# Let the kernel wait for the whole requested size when it can
+MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
+
+_socket_pool: Dict[Tuple[str, bool], socket.socket] = {}
+
+# Receive buffer for UDP responses, large enough for any datagram
+_udp_buf = bytearray(UDP_MAX_DATAGRAM_SIZE)
+_udp_view = memoryview(_udp_buf)
+
+
+class KerberosError(Exception):
+    """ The KDC answered with a KRB_ERROR which does not contain the salt """
+
+    def __init__(self, error_code: Optional[int], *args: Any) -> None:
+        super().__init__(error_code, *args)
+        self.error_code = error_code
+
+    def __str__(self) -> str:
+        return f"The KDC returned a KRB_ERROR (error code {self.error_code})"
+
+
+# Tagging options shared by the _fields of the classes below
+_EXPL0 = {'explicit': 0}
+_EXPL1 = {'explicit': 1}
+_EXPL2 = {'explicit': 2}
+_EXPL3 = {'explicit': 3}
+_EXPL4 = {'explicit': 4}
+_EXPL5 = {'explicit': 5}
+_EXPL6 = {'explicit': 6}
+_EXPL7 = {'explicit': 7}
+_EXPL9 = {'explicit': 9}
+_EXPL10 = {'explicit': 10}
+_OPT_EXPL1 = {'explicit': 1, 'optional': True}
+_OPT_EXPL2 = {'explicit': 2, 'optional': True}
+_OPT_EXPL3 = {'explicit': 3, 'optional': True}
+_OPT_EXPL4 = {'explicit': 4, 'optional': True}
+_OPT_EXPL6 = {'explicit': 6, 'optional': True}
+_OPT_EXPL7 = {'explicit': 7, 'optional': True}
+_OPT_EXPL8 = {'explicit': 8, 'optional': True}
+_OPT_EXPL9 = {'explicit': 9, 'optional': True}
+_OPT_EXPL10 = {'explicit': 10, 'optional': True}
+_OPT_EXPL11 = {'explicit': 11, 'optional': True}
+_OPT_EXPL12 = {'explicit': 12, 'optional': True}
+
+
 class EncryptedData(Sequence):
-    _fields = [
-        ('etype', Integer, {'explicit': 0}),
-        ('kvno', Integer, {'explicit': 1, 'optional': True}),
-        ('cipher', OctetString, {'explicit': 2}),
-    ]
+    _fields = (
+        ('etype', Integer, _EXPL0),
+        ('kvno', Integer, _OPT_EXPL1),
+        ('cipher', OctetString, _EXPL2),
+    )
 
 class HostAddress(Sequence):
-    _fields = [
-        ('addr-type', Integer, {'explicit': 0}),
-        ('address', OctetString, {'explicit': 1}),
-    ]
+    _fields = (
+        ('addr-type', Integer, _EXPL0),
+        ('address', OctetString, _EXPL1),
+    )
 
 class HostAddresses(SequenceOf):
     _child_spec = HostAddress
@@ -78,10 +149,10 @@ class KerberosStrings(SequenceOf):
     _child_spec = KerberosString
 
 class PrincipalName(Sequence):
-    _fields = [
-        ('name-type', Integer, {'explicit': 0}),
-        ('name-string', KerberosStrings, {'explicit': 1})
-    ]
+    _fields = (
+        ('name-type', Integer, _EXPL0),
+        ('name-string', KerberosStrings, _EXPL1)
+    )
 
 class KerberosFlags(BitString):
     pass
@@ -117,59 +188,59 @@ class KerberosTime(GeneralizedTime):
     pass
 
 class Ticket(Sequence):
-    _fields = [
-        ('tkt-vno', Integer, {'explicit': 0}),
-        ('realm', Realm, {'explicit': 1}),
-        ('sname', PrincipalName, {'explicit': 2}),
-        ('enc-part', EncryptedData, {'explicit': 3}),
-    ]
+    _fields = (
+        ('tkt-vno', Integer, _EXPL0),
+        ('realm', Realm, _EXPL1),
+        ('sname', PrincipalName, _EXPL2),
+        ('enc-part', EncryptedData, _EXPL3),
+    )
 
 class Tickets(SequenceOf):
     _child_spec = Ticket
 
 class KDC_REQ_BODY(Sequence):
-    _fields = [
-        ('kdc-options', KDCOptions, {'explicit': 0}),
-        ('cname', PrincipalName, {'explicit': 1, 'optional': True}),
-        ('realm', Realm, {'explicit': 2}),
-        ('sname', PrincipalName, {'explicit': 3, 'optional': True}),
-        ('from', KerberosTime, {'explicit': 4, 'optional': True}),
-        ('till', KerberosTime, {'explicit': 5}),
-        ('rtime', KerberosTime, {'explicit': 6, 'optional': True}),
-        ('nonce', Integer, {'explicit': 7}),
-        ('etype', Integers, {'explicit': 8, 'optional': True}),
-        ('addresses', HostAddresses, {'explicit': 9, 'optional': True}),
-        ('enc-authorization-data', EncryptedData, {'explicit': 10, 'optional': True}),
-        ('additional-tickets', Tickets, {'explicit': 11, 'optional': True})
-    ]
+    _fields = (
+        ('kdc-options', KDCOptions, _EXPL0),
+        ('cname', PrincipalName, _OPT_EXPL1),
+        ('realm', Realm, _EXPL2),
+        ('sname', PrincipalName, _OPT_EXPL3),
+        ('from', KerberosTime, _OPT_EXPL4),
+        ('till', KerberosTime, _EXPL5),
+        ('rtime', KerberosTime, _OPT_EXPL6),
+        ('nonce', Integer, _EXPL7),
+        ('etype', Integers, _OPT_EXPL8),
+        ('addresses', HostAddresses, _OPT_EXPL9),
+        ('enc-authorization-data', EncryptedData, _OPT_EXPL10),
+        ('additional-tickets', Tickets, _OPT_EXPL11)
+    )
 
 class PA_DATA(Sequence):
-    _fields = [
-        ('padata-type', Integer, {'explicit': 1}),
-        ('padata-value', OctetString, {'explicit': 2})
-    ]
+    _fields = (
+        ('padata-type', Integer, _EXPL1),
+        ('padata-value', OctetString, _EXPL2)
+    )
 
 class PA_DATA_SEQUENCE_OF(SequenceOf):
     _child_spec = PA_DATA
 
 class KRB_KDC_REQ(Sequence):
-    _fields = [
-        ('pvno', Integer, {'explicit': 1}),
-        ('msg-type', Integer, {'explicit': 2}),
-        ('padata', PA_DATA_SEQUENCE_OF, {'explicit': 3, 'optional': True}),
-        ('req-body', KDC_REQ_BODY, {'explicit': 4}),
-    ]
+    _fields = (
+        ('pvno', Integer, _EXPL1),
+        ('msg-type', Integer, _EXPL2),
+        ('padata', PA_DATA_SEQUENCE_OF, _OPT_EXPL3),
+        ('req-body', KDC_REQ_BODY, _EXPL4),
+    )
 
 class KRB_KDC_REP(Sequence):
-    _fields = [
-        ('pvno', Integer, {'explicit': 0}),
-        ('msg-type', Integer, {'explicit': 1}),
-        ('padata', PA_DATA_SEQUENCE_OF, {'explicit': 2, 'optional': True}),
-        ('crealm', Realm, {'explicit': 3}),
-        ('cname', PrincipalName, {'explicit': 4}),
-        ('ticket', Ticket, {'explicit': 5}),
-        ('enc-part', EncryptedData, {'explicit': 6}),
-    ]
+    _fields = (
+        ('pvno', Integer, _EXPL0),
+        ('msg-type', Integer, _EXPL1),
+        ('padata', PA_DATA_SEQUENCE_OF, _OPT_EXPL2),
+        ('crealm', Realm, _EXPL3),
+        ('cname', PrincipalName, _EXPL4),
+        ('ticket', Ticket, _EXPL5),
+        ('enc-part', EncryptedData, _EXPL6),
+    )
 
 class KRB_AS_REQ(KRB_KDC_REQ):
     explicit = (APPLICATION_TAG, AS_REQ_TAG_NUMBER)
@@ -179,126 +250,437 @@ class KRB_AS_REP(KRB_KDC_REP):
 
 class KRB_ERROR(Sequence):
     explicit = (APPLICATION_TAG, KRB_ERROR_TAG_NUMBER)
-    _fields = [
-        ('pvno', Integer, {'explicit': 0}),
-        ('msg-type', Integer, {'explicit': 1}),
-        ('ctime', KerberosTime, {'explicit': 2, 'optional': True}),
-        ('cusec', Integer, {'explicit': 3, 'optional': True}),
-        ('stime', KerberosTime, {'explicit': 4}),
-        ('susec', Integer, {'explicit': 5}),
-        ('error-code', Integer, {'explicit': 6}),
-        ('crealm', Realm, {'explicit': 7, 'optional': True}),
-        ('cname', PrincipalName, {'explicit': 8, 'optional': True}),
-        ('realm', Realm, {'explicit': 9}),
-        ('sname', PrincipalName, {'explicit': 10}),
-        ('e-text', KerberosString, {'explicit': 11, 'optional': True}),
-        ('e-data', OctetString, {'explicit': 12, 'optional': True}),
-    ]
+    _fields = (
+        ('pvno', Integer, _EXPL0),
+        ('msg-type', Integer, _EXPL1),
+        ('ctime', KerberosTime, _OPT_EXPL2),
+        ('cusec', Integer, _OPT_EXPL3),
+        ('stime', KerberosTime, _EXPL4),
+        ('susec', Integer, _EXPL5),
+        ('error-code', Integer, _EXPL6),
+        ('crealm', Realm, _OPT_EXPL7),
+        ('cname', PrincipalName, _OPT_EXPL8),
+        ('realm', Realm, _EXPL9),
+        ('sname', PrincipalName, _EXPL10),
+        ('e-text', KerberosString, _OPT_EXPL11),
+        ('e-data', OctetString, _OPT_EXPL12),
+    )
 
 class ETYPE_INFO2_ENTRY(Sequence):
-    _fields = [
-        ('etype', Integer, {'explicit': 0}),
-        ('salt', KerberosString, {'explicit': 1, 'optional': True}),
-        ('s2kparams', OctetString, {'explicit': 2, 'optional': True})
-    ]
+    _fields = (
+        ('etype', Integer, _EXPL0),
+        ('salt', KerberosString, _OPT_EXPL1),
+        ('s2kparams', OctetString, _OPT_EXPL2)
+    )
 
 class ETYPE_INFO2(SequenceOf):
     _child_spec = ETYPE_INFO2_ENTRY
 
 
-def build_as_req(username: str, domain: str) -> AnyType:
-    as_req = KRB_AS_REQ()
-    as_req['pvno'] = 5
-    as_req['msg-type'] = AS_MSG_TYPE
+def _principal_name(name_type: int, components: Iterable[str]) -> bytes:
+    name_string = b''.join(emit_tlv(GENERAL_STRING, c.encode('latin1')) for c in components)
+    return emit_tlv(SEQUENCE,
+        emit_tlv(context(0), emit_integer(name_type))
+        + emit_tlv(context(1), emit_tlv(SEQUENCE, name_string)))
+
+
+# DER encoding of the KRB_AS_REQ fields which never change
+_PVNO_DER = emit_tlv(context(1), emit_integer(5))
+_MSG_TYPE_DER = emit_tlv(context(2), emit_integer(AS_MSG_TYPE))
+# TODO: check if some flags are necessary in some cases (e.g. renewable-ok)
+_KDC_OPTIONS_DER = emit_tlv(context(0), emit_tlv(BIT_STRING, b'\x00'))
+_TILL_DER = emit_tlv(context(5), emit_tlv(GENERALIZED_TIME, TIME_T_ZERO.encode('ascii')))
+_ETYPE_DER = emit_tlv(context(8), emit_tlv(SEQUENCE,
+    emit_integer(AES128_CTS_HMAC_SHA1_96_ENC_TYPE)
+    + emit_integer(AES256_CTS_HMAC_SHA1h96_ENC_TYPE)))
 
-    req_body = KDC_REQ_BODY()
-    req_body['kdc-options'] = KDCOptions(set())
-    # TODO: check if some flags are necessary in some cases
-    #req_body['kdc-options'] = KDCOptions({'renewable-ok'})
 
-    cname = PrincipalName()
-    cname['name-type'] = NT_PRINCIPAL
-    cname['name-string'] = KerberosStrings([username])
-    req_body['cname'] = cname
+# realm and sname only depend on the domain, which is usually the same for
+# all the principals
+@functools.lru_cache(maxsize=16)
+def _realm_der(domain: str) -> bytes:
+    return emit_tlv(context(2), emit_tlv(GENERAL_STRING, domain.encode('latin1')))
 
-    req_body['realm'] = domain
 
-    sname = PrincipalName()
-    sname['name-type'] = NT_SRV_INST
-    sname['name-string'] = KerberosStrings(['krbtgt', domain])
-    req_body['sname'] = sname
+@functools.lru_cache(maxsize=16)
+def _sname_der(domain: str) -> bytes:
+    return emit_tlv(context(3), _principal_name(NT_SRV_INST, ['krbtgt', domain]))
 
-    req_body['till'] = KerberosTime(TIME_T_ZERO)
 
-    # TODO: ensure those properties from RFC 4120 :
-    # - "Nonces MUST NEVER be reused"
+@functools.lru_cache(maxsize=16)
+def _as_req_template(username: str, domain: str) -> Tuple[bytes, bytes]:
+    """
+    Return the DER encoded KRB_AS_REQ for <username>@<domain> split around
+    the 4 bytes of the nonce value, which is the only part changing between
+    two requests for the same principal.
+    """
+    req_body = emit_tlv(SEQUENCE,
+        _KDC_OPTIONS_DER
+        + emit_tlv(context(1), _principal_name(NT_PRINCIPAL, [username]))
+        + _realm_der(domain)
+        + _sname_der(domain)
+        + _TILL_DER
+        + emit_tlv(context(7), emit_integer(NONCE_MIN_VAL))
+        + _ETYPE_DER)
+
+    as_req = emit_tlv(application(AS_REQ_TAG_NUMBER), emit_tlv(SEQUENCE,
+        _PVNO_DER + _MSG_TYPE_DER + emit_tlv(context(4), req_body)))
+
+    # etype is the last field of the request, right after the nonce
+    nonce_off = len(as_req) - len(_ETYPE_DER) - NONCE_LENGTH
+    return (as_req[:nonce_off], as_req[nonce_off + NONCE_LENGTH:])
+
+
+def _build_as_req_into(buf: bytearray, username: str, domain: str) -> None:
+    """
+    Append the DER encoded KRB_AS_REQ for <username>@<domain> to <buf>
+    """
+    # RFC 4120: "Nonces MUST NEVER be reused", hence the use of a CSPRNG.
+    # Although the RFC defines the nonce as a uint32, DCs seem to reject
+    # values above 0x7FFFFFFF (the max value of an int32). The nonce is also
+    # never lower than NONCE_MIN_VAL so that its DER encoding always takes
+    # NONCE_LENGTH bytes and can be spliced in the template.
+    # TODO: ensure this property from RFC 4120 :
     # - "The encrypted part of the KRB_AS_REP message also contains the nonce
     # that MUST be matched with the nonce from the KRB_AS_REQ message"
-    # XXX: it seems that the nonce cannot be bigger than 0x7FFFFFFF. Why ? The
-    # RFC says that the nonce is a uint32, its max value should be 0xFFFFFFFF.
-    # 0x7FFFFFFF is the max value of an int32.
-    #req_body['nonce'] = random.randint(0, UINT32_MAX_VAL)
-    req_body['nonce'] = random.randint(0, INT32_MAX_VAL)
+    nonce = NONCE_MIN_VAL | secrets.randbits(NONCE_RANDOM_BITS)
+    head, tail = _as_req_template(username, domain)
+    buf += head
+    buf += nonce.to_bytes(NONCE_LENGTH, 'big')
+    buf += tail
 
-    etype = Integers([AES128_CTS_HMAC_SHA1_96_ENC_TYPE, AES256_CTS_HMAC_SHA1h96_ENC_TYPE])
-    req_body['etype'] = etype
 
-    as_req['req-body'] = req_body
+def build_as_req(username: str, domain: str) -> bytes:
+    """
+    Build a DER encoded KRB_AS_REQ without pre-authentication data.
 
-    return as_req.dump()
+    The encoding is done by hand (see KRB_AS_REQ for the structure) as
+    asn1crypto is way slower for such a fixed message.
+    """
+    buf = bytearray()
+    _build_as_req_into(buf, username, domain)
+    return bytes(buf)
 
 
-def send_as_req(dc: str, username: str, domain: str, udp: bool = False) -> bytes:
+def _recv_exact(s: socket.socket, size: int) -> bytearray:
+    """
+    Receive exactly <size> bytes from the stream socket <s>
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    off = 0
+    while off < size:
+        received = s.recv_into(view[off:], size - off, MSG_WAITALL)
+        if received == 0:
+            raise ConnectionError(f"Connection closed after {off} of {size} bytes")
+        off += received
+    return buf
+
+
+def _connect(dc: str, udp: bool) -> socket.socket:
+    # Timeouts are set before connecting so that a dead DC cannot hang us
     if udp:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect((dc, KERBEROS_PORT))
-            s.sendall(build_as_req(username, domain))
-            s.settimeout(10)
-            return s.recv(1024)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | SOCK_CLOEXEC)
+        s.settimeout(UDP_TIMEOUT)
     else:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s = socket.create_connection((dc, KERBEROS_PORT), timeout=TCP_TIMEOUT)
+    try:
+        if udp:
             s.connect((dc, KERBEROS_PORT))
-            data = build_as_req(username, domain)
-            # RFC 4120: "Each request (KRB_KDC_REQ) and response (KRB_KDC_REP
-            # or KRB_ERROR) sent over the TCP stream is preceded by the length
-            # of the request as 4 octets in network byte order"
-            request_length = struct.pack('!i', len(data))
-            s.sendall(request_length + data)
+        else:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        s.close()
+        raise
+    if s.family == socket.AF_INET:
+        # Only a hint, salt retrieval must not fail because of it
+        try:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, IPTOS_LOWDELAY)
+        except OSError as e:
+            logging.debug("Could not set IP_TOS on socket to %s: %s", dc, e)
+    return s
+
+
+def _is_reusable(s: socket.socket) -> bool:
+    """
+    Check that a pooled socket has no pending error (e.g. ICMP port
+    unreachable on UDP) and that nothing is waiting to be read on it: either
+    the peer closed the TCP connection or a late response to a previous
+    request is pending.
+    """
+    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+        return False
+    timeout = s.gettimeout()
+    s.setblocking(False)
+    try:
+        s.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        s.settimeout(timeout)
+    return False
+
+
+def _socket_pool_enabled() -> bool:
+    """
+    The pool is disabled when DISABLE_SOCKET_POOL_ENV is set to a true
+    boolean value, as understood by configparser (1, yes, true, on)
+    """
+    value = os.environ.get(DISABLE_SOCKET_POOL_ENV, '').strip().lower()
+    if not value:
+        return True
+    if value not in configparser.ConfigParser.BOOLEAN_STATES:
+        logging.warning("Invalid value for %s: %s, the socket pool is enabled",
+                        DISABLE_SOCKET_POOL_ENV, value)
+        return True
+    return not configparser.ConfigParser.BOOLEAN_STATES[value]
 
-            response_length = struct.unpack('!i', s.recv(4))[0]
-            return s.recv(response_length)
+
+def _get_socket(dc: str, udp: bool) -> Tuple[socket.socket, bool]:
+    """
+    Return a socket connected to the KDC of <dc>, reusing the pooled one
+    if it is still usable, and whether it was reused.
+    """
+    key = (dc, udp)
+    s = _socket_pool.get(key)
+    if s is not None:
+        if _is_reusable(s):
+            return (s, True)
+        s.close()
+    s = _connect(dc, udp)
+    _socket_pool[key] = s
+    return (s, False)
+
+
+def _discard_socket(dc: str, udp: bool) -> None:
+    s = _socket_pool.pop((dc, udp), None)
+    if s is not None:
+        s.close()
+
+
+def close_sockets() -> None:
+    """
+    Close all the pooled sockets
+    """
+    for s in _socket_pool.values():
+        s.close()
+    _socket_pool.clear()
+
+
+atexit.register(close_sockets)
+
+
+def _exchange(s: socket.socket, usernames: List[str], domain: str, udp: bool) -> Iterator[bytes]:
+    """
+    Send an AS_REQ for each of <usernames> to the KDC over <s> and yield
+    the responses, in the same order.
+    """
+    buf = bytearray()
+    if udp:
+        for username in usernames:
+            del buf[:]
+            _build_as_req_into(buf, username, domain)
+            s.sendall(buf)
+            size = s.recv_into(_udp_buf)
+            yield bytes(_udp_view[:size])
+    else:
+        # RFC 4120: "Each request (KRB_KDC_REQ) and response (KRB_KDC_REP
+        # or KRB_ERROR) sent over the TCP stream is preceded by the length
+        # of the request as 4 octets in network byte order"
+        # All the requests are encoded right after a reserved length prefix,
+        # which is filled in place, and sent at once. The KDC answers them
+        # in order.
+        for username in usernames:
+            off = len(buf)
+            buf += bytes(4)
+            _build_as_req_into(buf, username, domain)
+            buf[off:off + 4] = (len(buf) - off - 4).to_bytes(4, 'big')
+        s.sendall(buf)
+        for _ in usernames:
+            response_length = int.from_bytes(_recv_exact(s, 4), 'big')
+            yield bytes(_recv_exact(s, response_length))
+
+
+def _send_as_reqs(dc: str, usernames: List[str], domain: str, udp: bool) -> List[bytes]:
+    """
+    Send an AS_REQ for each of <usernames> to the KDC of <dc> and return
+    the responses, in the same order.
+
+    RFC 4120 7.2.2 allows the KDC to close a TCP connection after sending a
+    response: in this case, the requests which were not answered yet are
+    sent again over a new connection. A reused socket failing before any
+    response is also replaced by a new one: it may have gone stale while
+    idle (state dropped by a firewall, peer gone, DC address change...).
+    """
+    use_pool = _socket_pool_enabled()
+    responses: List[bytes] = []
+    while len(responses) < len(usernames):
+        answered = len(responses)
+        if use_pool:
+            s, reused = _get_socket(dc, udp)
+        else:
+            s, reused = _connect(dc, udp), False
+        try:
+            for response in _exchange(s, usernames[answered:], domain, udp):
+                responses.append(response)
+        except OSError as e:
+            if use_pool:
+                _discard_socket(dc, udp)
+            # Retry if the connection was useful, or if it was a pooled one
+            if len(responses) == answered and not reused:
+                raise
+            logging.debug("Connection to %s failed (%s), retrying on a new one", dc, e)
+        finally:
+            if not use_pool:
+                s.close()
+    return responses
+
+
+def send_as_req(dc: str, username: str, domain: str, udp: bool = False) -> bytes:
+    return _send_as_reqs(dc, [username], domain, udp)[0]
+
+
+def _get_salt_from_etype_info2(buf: bytes, off: int, etypes: Container[int]) -> Optional[str]:
+    """
+    Return the salt of the first ETYPE_INFO2_ENTRY of the ETYPE_INFO2 starting
+    at <off> in <buf> whose etype is in <etypes>, or None if there is none.
+    """
+    _, _, value_off, next_off = read_tlv(buf, off)
+    for _, entry_off, entry_end in iter_tlvs(buf, value_off, next_off):
+        etype = None
+        salt = None
+        for field, field_off, _ in iter_tlvs(buf, entry_off, entry_end):
+            if field == context(0):
+                etype = read_integer(buf, field_off)
+            elif field == context(1):
+                salt = read_string(buf, field_off)
+        if etype in etypes and salt is not None:
+            return salt
+    return None
+
+
+def _find_salt_in_etype_info2(buf: bytes, off: int, etype: int) -> Optional[str]:
+    """
+    Fast path of _get_salt_from_etype_info2 for a single <etype>: instead
+    of walking every ETYPE_INFO2_ENTRY, look for the DER encoding of its
+    first field ([0] INTEGER <etype>) and only decode the entry containing
+    it. Returns None if the entry could not be found this way.
+    """
+    _, _, value_off, next_off = read_tlv(buf, off)
+    marker = bytes((context(0), 3, INTEGER, 1, etype))
+    idx = buf.find(marker, value_off, next_off)
+    # The marker must directly follow the (short form) SEQUENCE header of
+    # the entry
+    if idx < value_off + 2 or buf[idx - 2] != SEQUENCE or buf[idx - 1] & 0x80:
+        return None
+    entry_end = idx + buf[idx - 1]
+    if entry_end > next_off:
+        return None
+    for field, field_off, field_end in iter_tlvs(buf, idx, entry_end):
+        # A false match could make a field overflow the entry
+        if field_end > entry_end:
+            return None
+        if field == context(1):
+            return read_string(buf, field_off)
+    return None
 
 
 def get_salt_from_rep(kdc_rep: bytes) -> str:
-    tag = Any.load(kdc_rep).tag
-    if tag == KRB_ERROR_TAG_NUMBER:
-        err = KRB_ERROR.load(kdc_rep)
-        error_code = err['error-code'].native
-        if error_code == KDC_ERR_PREAUTH_REQUIRED:
-            for padata in PA_DATA_SEQUENCE_OF.load(err['e-data'].native):
-                if padata['padata-type'].native == PA_ETYPE_INFO2:
-                    etype = ETYPE_INFO2()
-                    for pa_etype_info2_value in etype.load(padata['padata-value'].native):
-                        if pa_etype_info2_value['etype'].native == AES256_CTS_HMAC_SHA1h96_ENC_TYPE:
-                            # XXX: Adding str just for mypy
-                            return str(pa_etype_info2_value['salt'].native)
-    elif tag == AS_REP_TAG_NUMBER:
+    tag, _, value_off, next_off = read_tlv(kdc_rep, 0)
+    if tag == application(KRB_ERROR_TAG_NUMBER):
+        # Walk the KRB_ERROR fields once, only decoding error-code and e-data
+        _, _, value_off, next_off = read_tlv(kdc_rep, value_off)
+        error_code = None
+        e_data_off = None
+        for field, field_off, _ in iter_tlvs(kdc_rep, value_off, next_off):
+            if field == context(6):
+                error_code = read_integer(kdc_rep, field_off)
+            elif field == context(12):
+                # e-data is an OCTET STRING encapsulating a PA_DATA_SEQUENCE_OF
+                e_data_off = read_tlv(kdc_rep, field_off)[2]
+        if error_code == KDC_ERR_PREAUTH_REQUIRED and e_data_off is not None:
+            _, _, value_off, next_off = read_tlv(kdc_rep, e_data_off)
+            for _, padata_off, padata_end in iter_tlvs(kdc_rep, value_off, next_off):
+                padata_type = None
+                padata_value_off = None
+                for field, field_off, _ in iter_tlvs(kdc_rep, padata_off, padata_end):
+                    if field == context(1):
+                        padata_type = read_integer(kdc_rep, field_off)
+                    elif field == context(2):
+                        padata_value_off = read_tlv(kdc_rep, field_off)[2]
+                if padata_type == PA_ETYPE_INFO2 and padata_value_off is not None:
+                    salt = _find_salt_in_etype_info2(kdc_rep, padata_value_off,
+                        AES256_CTS_HMAC_SHA1h96_ENC_TYPE)
+                    if salt is None:
+                        salt = _get_salt_from_etype_info2(kdc_rep, padata_value_off,
+                            (AES256_CTS_HMAC_SHA1h96_ENC_TYPE,))
+                    if salt is not None:
+                        return salt
+        if error_code != KDC_ERR_PREAUTH_REQUIRED:
+            raise KerberosError(error_code)
+        raise Exception("Could not retrieve salt from KRB_ERROR (error code %s)" % error_code)
+    elif tag == application(AS_REP_TAG_NUMBER):
         # In this case the gMSA has the DONT_REQUIRE_PREAUTH flag in its
         # userAccountControl attribute
         as_rep = KRB_AS_REP.load(kdc_rep)
-        for padata in as_rep['padata'].native:
-            if padata['padata-type'] == PA_ETYPE_INFO2:
-                etype = ETYPE_INFO2()
-                for pa_etype_info2_value in etype.load(padata['padata-value']):
-                    if pa_etype_info2_value['etype'].native == AES256_CTS_HMAC_SHA1h96_ENC_TYPE \
-                        or pa_etype_info2_value['etype'].native == AES128_CTS_HMAC_SHA1_96_ENC_TYPE:
-                        # XXX: Adding str just for mypy
-                        return str(pa_etype_info2_value['salt'])
-    raise Exception("Could not retrieve salt from AS_REP (tag number %d)" % tag)
+        # Avoid .native on the whole padata, which decodes every field
+        for padata in as_rep['padata']:
+            if padata['padata-type'].native == PA_ETYPE_INFO2:
+                # No need to load padata-value with asn1crypto again
+                salt = _get_salt_from_etype_info2(padata['padata-value'].contents, 0,
+                    (AES256_CTS_HMAC_SHA1h96_ENC_TYPE, AES128_CTS_HMAC_SHA1_96_ENC_TYPE))
+                if salt is not None:
+                    return salt
+    raise Exception("Could not retrieve salt from AS_REP (tag number %d)" % (tag & 0x1f))
 
 
 def get_salt_from_preauth(dc: str, username: str, domain: str) -> str:
-    return get_salt_from_rep(send_as_req(dc, username, domain))
+    # RFC 4120 7.2.1: try UDP first, and TCP if the DC could not be reached
+    # over UDP or if the response does not fit in a datagram
+    try:
+        return get_salt_from_rep(send_as_req(dc, username, domain, udp=True))
+    except KerberosError as e:
+        if e.error_code != KRB_ERR_RESPONSE_TOO_BIG:
+            raise
+        logging.debug("Response from %s is too big for UDP, retrying over TCP", dc)
+    except OSError as e:
+        logging.debug("Could not retrieve salt from %s over UDP (%s), retrying over TCP", dc, e)
+    return get_salt_from_rep(send_as_req(dc, username, domain, udp=False))
+
+
+def get_salts_from_preauth(dc: str, usernames: Iterable[str], domain: str) -> List[Optional[str]]:
+    """
+    Retrieve the salts of several principals of <domain>, sending all the
+    AS_REQ back-to-back over a single TCP connection to <dc>
+
+    The salt of a principal whose response does not contain it (e.g.
+    unknown principal) is None, the error being logged. Network errors
+    are raised.
+    """
+    usernames = list(usernames)
+    salts: List[Optional[str]] = []
+    for username, rep in zip(usernames, _send_as_reqs(dc, usernames, domain, udp=False)):
+        try:
+            salts.append(get_salt_from_rep(rep))
+        except Exception as e:
+            logging.warning("Could not retrieve salt of %s@%s: %s", username, domain, e)
+            salts.append(None)
+    return salts
+
+
+def get_salts_from_heuristic(sam_account_names: Iterable[str], domain: str) -> List[str]:
+    """
+    Generate salts for several gMSA accounts (considered as computers) of
+    the same domain
+
+    See [MS-KILE] 3.1.1.2
+    """
+    prefix = f'{domain.upper()}host'
+    suffix = f'.{domain.lower()}'
+    return [prefix + name.rstrip('$') + suffix for name in sam_account_names]
 
 
 def get_salt_from_heuristic(sam_account_name: str, domain: str) -> str:
@@ -307,5 +689,4 @@ def get_salt_from_heuristic(sam_account_name: str, domain: str) -> str:
 
     See [MS-KILE] 3.1.1.2
     """
-    sAMAccountName = sam_account_name.rstrip('$')
-    return f'{domain.upper()}host{sAMAccountName}.{domain.lower()}'
+    return get_salts_from_heuristic([sam_account_name], domain)[0]
@@ -0,0 +1,325 @@
+import os
+import select
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from gmsad.salt import build_as_req, get_salt_from_rep, get_salt_from_preauth, \
+    get_salts_from_preauth, get_salts_from_heuristic, close_sockets, KerberosError, \
+    _find_salt_in_etype_info2, _connect, _exchange, _send_as_reqs, _recv_exact, _is_reusable, \
+    _socket_pool, _socket_pool_enabled, DISABLE_SOCKET_POOL_ENV, \
+    KRB_AS_REQ, KRB_AS_REP, KRB_ERROR, PA_DATA_SEQUENCE_OF, ETYPE_INFO2, \
+    KDC_ERR_PREAUTH_REQUIRED, KRB_ERR_RESPONSE_TOO_BIG, PA_ETYPE_INFO2, TIME_T_ZERO
+
+USERNAME = "super_gmsa$"
+DOMAIN = "WINDOMAIN.LOCAL"
+SALT = "WINDOMAIN.LOCALhostsuper_gmsa.windomain.local"
+
+
+def build_krb_error(error_code: int, etype_info2: list) -> bytes:
+    err = KRB_ERROR()
+    err['pvno'] = 5
+    err['msg-type'] = 30
+    err['stime'] = TIME_T_ZERO
+    err['susec'] = 0
+    err['error-code'] = error_code
+    err['realm'] = DOMAIN
+    err['sname'] = {'name-type': 2, 'name-string': ['krbtgt', DOMAIN]}
+    err['e-data'] = PA_DATA_SEQUENCE_OF([
+        {'padata-type': 2, 'padata-value': b''},
+        {'padata-type': PA_ETYPE_INFO2, 'padata-value': ETYPE_INFO2(etype_info2).dump()},
+    ]).dump()
+    return err.dump()
+
+
+def build_as_rep(etype_info2: list) -> bytes:
+    as_rep = KRB_AS_REP()
+    as_rep['pvno'] = 5
+    as_rep['msg-type'] = 11
+    as_rep['padata'] = [
+        {'padata-type': PA_ETYPE_INFO2, 'padata-value': ETYPE_INFO2(etype_info2).dump()},
+    ]
+    as_rep['crealm'] = DOMAIN
+    as_rep['cname'] = {'name-type': 1, 'name-string': [USERNAME]}
+    as_rep['ticket'] = {
+        'tkt-vno': 5,
+        'realm': DOMAIN,
+        'sname': {'name-type': 2, 'name-string': ['krbtgt', DOMAIN]},
+        'enc-part': {'etype': 18, 'cipher': b'ticket'},
+    }
+    as_rep['enc-part'] = {'etype': 18, 'cipher': b'enc-part'}
+    return as_rep.dump()
+
+
+class FakeKDC(threading.Thread):
+    """
+    TCP KDC on localhost answering <response> to every request. If
+    <replies_per_connection> is set, the connection is closed after this
+    number of responses.
+    """
+
+    def __init__(self, response: bytes, replies_per_connection: int = 0) -> None:
+        super().__init__(daemon=True)
+        self.response = response
+        self.replies_per_connection = replies_per_connection
+        self.connections = 0
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen()
+        self.server.settimeout(0.1)
+        self.port = self.server.getsockname()[1]
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            self.connections += 1
+            with conn:
+                conn.settimeout(None)
+                replies = 0
+                while not self.replies_per_connection or replies < self.replies_per_connection:
+                    try:
+                        request_length = int.from_bytes(_recv_exact(conn, 4), 'big')
+                        _recv_exact(conn, request_length)
+                    except ConnectionError:
+                        break
+                    conn.sendall(len(self.response).to_bytes(4, 'big') + self.response)
+                    replies += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+        self.server.close()
+
+
+class TestSalt(unittest.TestCase):
+
+    def test_build_as_req(self):
+        data = build_as_req(USERNAME, DOMAIN)
+        as_req = KRB_AS_REQ.load(data)
+        self.assertEqual(as_req['pvno'].native, 5)
+        self.assertEqual(as_req['msg-type'].native, 10)
+        req_body = as_req['req-body']
+        self.assertEqual(req_body['cname'].native,
+                         {'name-type': 1, 'name-string': [USERNAME]})
+        self.assertEqual(req_body['realm'].native, DOMAIN)
+        self.assertEqual(req_body['sname'].native,
+                         {'name-type': 2, 'name-string': ['krbtgt', DOMAIN]})
+        self.assertEqual(req_body['etype'].native, [17, 18])
+        # The hand-rolled encoding must match the one of asn1crypto
+        self.assertEqual(as_req.dump(force=True), data)
+
+    def test_build_as_req_nonce(self):
+        first = KRB_AS_REQ.load(build_as_req(USERNAME, DOMAIN))
+        second = KRB_AS_REQ.load(build_as_req(USERNAME, DOMAIN))
+        self.assertNotEqual(first['req-body']['nonce'].native,
+                            second['req-body']['nonce'].native)
+        second['req-body']['nonce'] = first['req-body']['nonce'].native
+        self.assertEqual(first.dump(), second.dump(force=True))
+
+    def test_get_salt_from_krb_error(self):
+        rep = build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [
+            {'etype': 23},
+            {'etype': 17, 'salt': 'not the right one'},
+            {'etype': 18, 'salt': SALT},
+        ])
+        self.assertEqual(get_salt_from_rep(rep), SALT)
+
+    def test_get_salt_from_krb_error_long_entry(self):
+        # The AES256 entry header uses the long form, so the salt cannot be
+        # found by the substring search fast path
+        salt = SALT * 4
+        rep = build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [
+            {'etype': 17, 'salt': salt},
+            {'etype': 18, 'salt': salt},
+        ])
+        self.assertEqual(get_salt_from_rep(rep), salt)
+
+    def test_find_salt_in_etype_info2_overflow(self):
+        # SEQUENCE { [0] INTEGER 18, [1] overflowing the entry } followed by
+        # bytes that would make a valid salt
+        etype_info2 = bytes.fromhex('300f' '3007' 'a0030201 12' 'a106' '1b04') + b'salt'
+        self.assertIsNone(_find_salt_in_etype_info2(etype_info2, 0, 18))
+
+    def test_get_salt_from_krb_error_without_aes256(self):
+        rep = build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 17, 'salt': SALT}])
+        with self.assertRaises(Exception):
+            get_salt_from_rep(rep)
+
+    def test_get_salt_from_other_krb_error(self):
+        rep = build_krb_error(6, [{'etype': 18, 'salt': SALT}])
+        with self.assertRaises(KerberosError) as cm:
+            get_salt_from_rep(rep)
+        self.assertEqual(cm.exception.error_code, 6)
+        self.assertEqual(cm.exception.args, (6,))
+
+    def test_get_salt_from_preauth_fallback(self):
+        too_big = build_krb_error(KRB_ERR_RESPONSE_TOO_BIG, [])
+        rep = build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 18, 'salt': SALT}])
+        with mock.patch('gmsad.salt.send_as_req', side_effect=[too_big, rep]) as send:
+            self.assertEqual(get_salt_from_preauth("dc", USERNAME, DOMAIN), SALT)
+        self.assertEqual([kwargs['udp'] for _, kwargs in send.call_args_list], [True, False])
+        with mock.patch('gmsad.salt.send_as_req', side_effect=[socket.timeout(), rep]) as send:
+            self.assertEqual(get_salt_from_preauth("dc", USERNAME, DOMAIN), SALT)
+        # Other errors are not retried over TCP
+        unknown = build_krb_error(6, [])
+        with mock.patch('gmsad.salt.send_as_req', side_effect=[unknown, rep]) as send:
+            with self.assertRaises(KerberosError):
+                get_salt_from_preauth("dc", USERNAME, DOMAIN)
+        self.assertEqual(send.call_count, 1)
+
+    def test_get_salts_from_preauth_partial_failure(self):
+        reps = [
+            build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 18, 'salt': SALT}]),
+            build_krb_error(6, []),
+            build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 17, 'salt': SALT}]),
+            build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 18, 'salt': SALT}]),
+        ]
+        with mock.patch('gmsad.salt._send_as_reqs', return_value=reps):
+            with self.assertLogs(level='WARNING'):
+                salts = get_salts_from_preauth("dc", ['a$', 'unknown$', 'no_aes256$', 'b$'], DOMAIN)
+        self.assertEqual(salts, [SALT, None, None, SALT])
+
+    def test_get_salt_from_as_rep(self):
+        rep = build_as_rep([{'etype': 23}, {'etype': 17, 'salt': SALT}])
+        self.assertEqual(get_salt_from_rep(rep), SALT)
+
+    def test_get_salts_from_heuristic(self):
+        self.assertEqual(
+            get_salts_from_heuristic(["super_gmsa$", "other_gmsa$"], "windomain.local"),
+            [SALT, "WINDOMAIN.LOCALhostother_gmsa.windomain.local"])
+
+    def test_recv_exact(self):
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(b'\x00\x00\x00\x05ab')
+            a.sendall(b'cde')
+            self.assertEqual(_recv_exact(b, 4), b'\x00\x00\x00\x05')
+            self.assertEqual(_recv_exact(b, 5), b'abcde')
+            a.close()
+            with self.assertRaises(ConnectionError):
+                _recv_exact(b, 1)
+
+    def test_is_reusable(self):
+        a, b = socket.socketpair()
+        with a, b:
+            b.settimeout(10)
+            self.assertTrue(_is_reusable(b))
+            self.assertEqual(b.gettimeout(), 10)
+            # A late response is pending
+            a.sendall(b'late')
+            self.assertFalse(_is_reusable(b))
+            b.recv(4)
+            self.assertTrue(_is_reusable(b))
+            # The peer closed the connection
+            a.close()
+            self.assertFalse(_is_reusable(b))
+
+    def test_exchange_tcp(self):
+        a, b = socket.socketpair()
+        with a, b:
+            # Responses of the KDC, in the order of the requests
+            a.sendall(b'\x00\x00\x00\x05first\x00\x00\x00\x06second')
+            self.assertEqual(list(_exchange(b, [USERNAME, "other_gmsa$"], DOMAIN, udp=False)),
+                             [b'first', b'second'])
+            for username in [USERNAME, "other_gmsa$"]:
+                request_length = int.from_bytes(_recv_exact(a, 4), 'big')
+                as_req = KRB_AS_REQ.load(bytes(_recv_exact(a, request_length)))
+                self.assertEqual(as_req['req-body']['cname']['name-string'].native, [username])
+
+    def test_exchange_udp(self):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        with a, b:
+            a.sendall(b'response' * 1024)
+            self.assertEqual(list(_exchange(b, [USERNAME], DOMAIN, udp=True)), [b'response' * 1024])
+            as_req = KRB_AS_REQ.load(a.recv(65535))
+            self.assertEqual(as_req['req-body']['cname']['name-string'].native, [USERNAME])
+
+    def run_fake_kdc(self, response: bytes, replies_per_connection: int = 0) -> FakeKDC:
+        kdc = FakeKDC(response, replies_per_connection)
+        kdc.start()
+        self.addCleanup(kdc.stop)
+        self.addCleanup(close_sockets)
+        patcher = mock.patch('gmsad.salt.KERBEROS_PORT', kdc.port)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return kdc
+
+    def test_socket_pool(self):
+        kdc = self.run_fake_kdc(b'response')
+        self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False), [b'response'])
+        pooled = _socket_pool[('127.0.0.1', False)]
+        self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False), [b'response'])
+        self.assertIs(_socket_pool[('127.0.0.1', False)], pooled)
+        self.assertEqual(kdc.connections, 1)
+
+    def test_socket_pool_peer_closed(self):
+        kdc = self.run_fake_kdc(b'response', replies_per_connection=1)
+        self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False), [b'response'])
+        pooled = _socket_pool[('127.0.0.1', False)]
+        # Wait for the KDC to close the connection
+        select.select([pooled], [], [], 5)
+        self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False), [b'response'])
+        self.assertIsNot(_socket_pool[('127.0.0.1', False)], pooled)
+        self.assertEqual(kdc.connections, 2)
+
+    def test_socket_pool_discard_on_error(self):
+        self.run_fake_kdc(b'response')
+        with mock.patch('gmsad.salt._recv_exact', side_effect=ConnectionResetError()):
+            with self.assertRaises(ConnectionResetError):
+                _send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False)
+        self.assertNotIn(('127.0.0.1', False), _socket_pool)
+
+    def test_socket_pool_stale_socket(self):
+        # The KDC closes the connection, but the pooled socket still looks
+        # usable (e.g. idle state silently dropped by a firewall)
+        kdc = self.run_fake_kdc(b'response', replies_per_connection=1)
+        self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False), [b'response'])
+        pooled = _socket_pool[('127.0.0.1', False)]
+        select.select([pooled], [], [], 5)
+        with mock.patch('gmsad.salt._is_reusable', return_value=True):
+            self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False),
+                             [b'response'])
+        self.assertIsNot(_socket_pool[('127.0.0.1', False)], pooled)
+        self.assertEqual(kdc.connections, 2)
+
+    def test_socket_pool_disabled(self):
+        kdc = self.run_fake_kdc(b'response')
+        with mock.patch.dict(os.environ, {DISABLE_SOCKET_POOL_ENV: '1'}):
+            for _ in range(2):
+                self.assertEqual(_send_as_reqs('127.0.0.1', [USERNAME], DOMAIN, udp=False),
+                                 [b'response'])
+        self.assertNotIn(('127.0.0.1', False), _socket_pool)
+        self.assertEqual(kdc.connections, 2)
+
+    def test_get_salts_from_preauth_connection_closed(self):
+        # The KDC closes the connection after each response
+        rep = build_krb_error(KDC_ERR_PREAUTH_REQUIRED, [{'etype': 18, 'salt': SALT}])
+        kdc = self.run_fake_kdc(rep, replies_per_connection=1)
+        self.assertEqual(get_salts_from_preauth('127.0.0.1', ['a$', 'b$', 'c$'], DOMAIN),
+                         [SALT] * 3)
+        self.assertEqual(kdc.connections, 3)
+
+    def test_connect_ip_tos_failure(self):
+        self.run_fake_kdc(b'response')
+        setsockopt = socket.socket.setsockopt
+
+        def failing_setsockopt(sock, level, option, value):
+            if (level, option) == (socket.IPPROTO_IP, socket.IP_TOS):
+                raise PermissionError()
+            return setsockopt(sock, level, option, value)
+
+        with mock.patch('socket.socket.setsockopt', failing_setsockopt):
+            with _connect('127.0.0.1', udp=False) as s:
+                self.assertEqual(s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR), 0)
+
+    def test_socket_pool_enabled(self):
+        for value, enabled in [('', True), ('0', True), ('no', True), ('off', True),
+                               ('1', False), ('yes', False), ('True', False), ('on', False),
+                               ('invalid', True)]:
+            with mock.patch.dict(os.environ, {DISABLE_SOCKET_POOL_ENV: value}):
+                self.assertEqual(_socket_pool_enabled(), enabled, value)